@@ -58,12 +58,30 @@ def get_metric_data_from_ec2_run(
     metrics_collection_end_time,
 ):
     metric_queries = _create_metric_queries(instance_id, instance_type)
-    response = cw_client.get_metric_data(
+    paginator = cw_client.get_paginator("get_metric_data")
+    pages = paginator.paginate(
         MetricDataQueries=metric_queries,
         StartTime=metrics_collection_start_time,
         EndTime=metrics_collection_end_time,
     )
-    return response
+
+    # A query's datapoints can be split across pages, so merge them by Id
+    results_by_id = {}
+    messages = []
+    for page in pages:
+        messages.extend(page.get("Messages", []))
+        for result in page["MetricDataResults"]:
+            merged = results_by_id.setdefault(
+                result["Id"], {**result, "Timestamps": [], "Values": []}
+            )
+            merged["Timestamps"].extend(result["Timestamps"])
+            merged["Values"].extend(result["Values"])
+            merged["StatusCode"] = result["StatusCode"]
+
+    return {
+        "MetricDataResults": list(results_by_id.values()),
+        "Messages": messages,
+    }
 
 
 def save_metrics_response_to_json(response, local_file_name):
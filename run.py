@@ -1,30 +1,71 @@
 import argparse
-import json
+import atexit
+import gzip
+import io
 import logging
+import logging.handlers
 import os
+import queue
+import shutil
 import subprocess
 import sys
-from datetime import datetime, timedelta
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone
 
 import boto3
+import orjson
+import urllib3
+from boto3.s3.transfer import TransferConfig
+from botocore.config import Config
 
 from benchmarking_utils.cloudwatch import get_metric_data_from_ec2_run
 
 
+MULTIPART_THRESHOLD = 8 * 1024 * 1024
+SPLICE_THRESHOLD = 10 * 1024 * 1024
+# Have S3 verify uploads server-side so corruption is caught at upload time
+UPLOAD_CHECKSUM_ARGS = {"ChecksumAlgorithm": "CRC32C"}
+
+IMDS_URL = "http://169.254.169.254/latest"
+IMDS_PATHS = {"-i": "instance-id", "-t": "instance-type"}
+
+# One keep-alive pool for the token and metadata requests
+_imds_http = urllib3.PoolManager(timeout=1, retries=False)
+_imds_token = None
+
+
+def _get_imds_token():
+    global _imds_token
+    if _imds_token is None:
+        response = _imds_http.request(
+            "PUT",
+            f"{IMDS_URL}/api/token",
+            headers={"X-aws-ec2-metadata-token-ttl-seconds": "21600"},
+        )
+        if response.status != 200:
+            raise urllib3.exceptions.HTTPError(
+                f"IMDS token request returned status {response.status}"
+            )
+        _imds_token = response.data.decode()
+    return _imds_token
+
+
 def get_ec2_metadata(option):
     try:
-        result = subprocess.run(
-            ["ec2-metadata", option],
-            check=True,
-            stdout=subprocess.PIPE,
-            stderr=subprocess.PIPE,
-            text=True,
+        response = _imds_http.request(
+            "GET",
+            f"{IMDS_URL}/meta-data/{IMDS_PATHS[option]}",
+            headers={"X-aws-ec2-metadata-token": _get_imds_token()},
         )
-        if result.stdout:
-            return result.stdout.split(": ")[1].strip()
-        return None
-    except subprocess.CalledProcessError as e:
-        print(f"Error calling ec2-metadata: {e}")
+        if response.status != 200:
+            raise urllib3.exceptions.HTTPError(
+                f"IMDS metadata request returned status {response.status}"
+            )
+        return response.data.decode().strip() or None
+    except urllib3.exceptions.HTTPError as e:
+        print(f"Error fetching EC2 metadata: {e}")
         return None
 
 
@@ -34,65 +75,184 @@ def custom_json_serializer(obj):
     raise TypeError(f"Type {type(obj)} not serializable")
 
 
+def add_custom_data_to_benchmark_json(benchmark_json, custom_data, pretty=False):
+    if len(benchmark_json) > SPLICE_THRESHOLD:
+        # Splice the key in before the closing brace of the top-level object
+        # rather than parsing and re-serialising the whole document
+        end = benchmark_json.rindex(b"}")
+        custom_json = orjson.dumps(custom_data, default=custom_json_serializer)
+        return b"".join(
+            [benchmark_json[:end].rstrip(), b',\n"custom": ', custom_json, b"\n}\n"]
+        )
+
+    benchmark_data = orjson.loads(benchmark_json)
+    benchmark_data["custom"] = custom_data
+    return orjson.dumps(
+        benchmark_data,
+        option=orjson.OPT_INDENT_2 if pretty else None,
+        default=custom_json_serializer,
+    )
+
+
 def setup_logging():
     logger = logging.getLogger(__name__)
     logger.setLevel(logging.INFO)
 
     stdout_handler = logging.StreamHandler(sys.stdout)
     stdout_handler.setLevel(logging.INFO)
-    logger.addHandler(stdout_handler)
+
+    # Write to stdout on a background thread so draining pytest output only
+    # has to enqueue each record
+    log_queue = queue.Queue(-1)
+    logger.addHandler(logging.handlers.QueueHandler(log_queue))
+    listener = logging.handlers.QueueListener(
+        log_queue, stdout_handler, respect_handler_level=True
+    )
+    listener.start()
+    atexit.register(listener.stop)
 
     return logger
 
 
-def run_pytest_benchmark(logger, max_pairs, num_input_rows, aws_region):
-    s3_client = boto3.client("s3", region_name=aws_region)
+def _tail_log_file(log_file, logger, process_done):
+    # Pieces of a line whose newline has not been read yet
+    partial = []
+    with open(log_file, "rb", buffering=0) as file:
+        while True:
+            # Check before reading, so an empty read after the process has
+            # exited means everything has been consumed
+            done = process_done.is_set()
+            chunk = file.read(65536)
+            if not chunk:
+                if done:
+                    break
+                time.sleep(0.1)
+                continue
+            lines = chunk.split(b"\n")
+            if len(lines) == 1:
+                partial.append(chunk)
+                continue
+            lines[0] = b"".join(partial) + lines[0]
+            tail = lines.pop()
+            partial = [tail] if tail else []
+            for line in lines:
+                logger.info(line.decode(errors="replace").strip())
+
+    if partial:
+        logger.info(b"".join(partial).decode(errors="replace").strip())
+
+
+def run_pytest_benchmark(
+    logger, max_pairs, num_input_rows, benchmark_json_file, pytest_log_file, s3_client
+):
     bucket_name = "robinsplinkbenchmarks"
     object_key = "data/7m_prepared.parquet"
     local_filename = "./7m_prepared.parquet"
     s3_client.download_file(bucket_name, object_key, local_filename)
 
-    command = [
-        sys.executable,
-        "-m",
-        "pytest",
+    # Call the pytest console script directly to skip runpy's start-up work
+    pytest_path = shutil.which("pytest")
+    pytest_command = [pytest_path] if pytest_path else [sys.executable, "-m", "pytest"]
+    command = pytest_command + [
         "-s",
         "-v",
         "benchmarks/test_7m_synthetic.py",
         "--benchmark-json",
-        "benchmarking_results.json",
+        benchmark_json_file,
         "--max_pairs",
         max_pairs,
         "--num_input_rows",
         num_input_rows,
     ]
 
-    process = subprocess.Popen(
-        command, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True
-    )
+    # pytest writes straight to the log file at the OS level, and a separate
+    # thread forwards it to the logger in large chunks
+    log_fd = os.open(pytest_log_file, os.O_CREAT | os.O_WRONLY | os.O_TRUNC, 0o644)
+    try:
+        process = subprocess.Popen(
+            command,
+            stdout=log_fd,
+            stderr=subprocess.STDOUT,
+            env={
+                **os.environ,
+                "PYTHONDONTWRITEBYTECODE": "1",
+                "PYTHONNOUSERSITE": "1",
+            },
+        )
+    finally:
+        os.close(log_fd)
 
-    while True:
-        output = process.stdout.readline()
-        if output == "" and process.poll() is not None:
-            break
-        if output:
-            logger.info(output.strip())
+    process_done = threading.Event()
+    tailer = threading.Thread(
+        target=_tail_log_file, args=(pytest_log_file, logger, process_done)
+    )
+    tailer.start()
 
-    rc = process.poll()
+    rc = process.wait()
+    process_done.set()
+    tailer.join()
     return rc
 
 
-def upload_file_to_s3(*, bucket_name, file_name, folder_path, logger, region_name):
-    s3_client = boto3.client("s3", region_name=region_name)
+def upload_file_to_s3(
+    *,
+    bucket_name,
+    file_name,
+    folder_path,
+    logger,
+    s3_client,
+    extra_args=None,
+    max_concurrency=20,
+):
     s3_file_path = f"{folder_path}/{file_name}"  # Key for S3 includes the folder path
-    s3_client.upload_file(file_name, bucket_name, s3_file_path)
+    extra_args = {**UPLOAD_CHECKSUM_ARGS, **(extra_args or {})}
+    transfer_config = TransferConfig(max_concurrency=max_concurrency)
+    s3_client.upload_file(
+        file_name,
+        bucket_name,
+        s3_file_path,
+        ExtraArgs=extra_args,
+        Config=transfer_config,
+    )
+    logger.info(
+        f"File '{file_name}' uploaded to '{s3_file_path}' in bucket '{bucket_name}'."
+    )
+
+
+def upload_bytes_to_s3(
+    *,
+    bucket_name,
+    data,
+    file_name,
+    folder_path,
+    logger,
+    s3_client,
+    extra_args=None,
+    max_concurrency=20,
+):
+    s3_file_path = f"{folder_path}/{file_name}"
+    extra_args = {**UPLOAD_CHECKSUM_ARGS, **(extra_args or {})}
+    # Small payloads go up in a single PUT, skipping the transfer manager
+    if len(data) < MULTIPART_THRESHOLD:
+        s3_client.put_object(
+            Bucket=bucket_name, Key=s3_file_path, Body=data, **extra_args
+        )
+    else:
+        transfer_config = TransferConfig(max_concurrency=max_concurrency)
+        s3_client.upload_fileobj(
+            io.BytesIO(data),
+            bucket_name,
+            s3_file_path,
+            ExtraArgs=extra_args,
+            Config=transfer_config,
+        )
     logger.info(
         f"File '{file_name}' uploaded to '{s3_file_path}' in bucket '{bucket_name}'."
     )
 
 
 if __name__ == "__main__":
-    metrics_collection_start_time = datetime.utcnow() - timedelta(minutes=1)
+    metrics_collection_start_time = datetime.now(timezone.utc) - timedelta(minutes=1)
 
     parser = argparse.ArgumentParser(
         description="Run pytest benchmarks with custom parameters."
@@ -135,6 +295,12 @@ if __name__ == "__main__":
         help="AWS region for the CloudWatch client.",
     )
 
+    parser.add_argument(
+        "--pretty",
+        action="store_true",
+        help="Indent the uploaded benchmark results JSON for readability.",
+    )
+
     args = parser.parse_args()
 
     # Use the parsed arguments
@@ -145,14 +311,32 @@ if __name__ == "__main__":
     aws_region = args.aws_region
     output_bucket = args.output_bucket
     output_folder = args.output_folder
-    current_time = datetime.now().strftime("%Y-%m-%d_%H-%M-%S")
 
-    cw_client = boto3.client("cloudwatch", region_name=aws_region)
+    # Share one session, and its loaded service models, between all clients
+    session = boto3.Session(region_name=aws_region)
+    client_config = Config(
+        max_pool_connections=32,
+        tcp_keepalive=True,
+        retries={"max_attempts": 10, "mode": "adaptive"},
+    )
+    cw_client = session.client("cloudwatch", config=client_config)
+    s3_client = session.client("s3", config=client_config)
 
     logger = setup_logging()
 
+    # The metrics query is keyed on both values, so only the two metadata
+    # lookups can overlap. They run before pytest so that it can write its
+    # results straight to the final file name
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        instance_id_future = executor.submit(get_ec2_metadata, "-i")
+        instance_type_future = executor.submit(get_ec2_metadata, "-t")
+        instance_id = instance_id_future.result()
+        instance_type = instance_type_future.result()
+
+    benchmark_file_name = f"benchmarking_results_{instance_id}_{run_label}.json"
+    pytest_log_file_name = f"pytest_{instance_id}_{run_label}.log"
+
     # Download test data
-    s3_client = boto3.client("s3", region_name=aws_region)
     bucket_name = "robinsplinkbenchmarks"
     object_key = "data/3m_prepared.parquet"
     local_filename = "3m_prepared.parquet"
@@ -161,12 +345,25 @@ if __name__ == "__main__":
     s3_client.download_file(bucket_name, object_key, local_filename)
 
     # Run pytest benchmark and log its output
-    return_code = run_pytest_benchmark(logger, max_pairs, num_input_rows, aws_region)
+    return_code = run_pytest_benchmark(
+        logger,
+        max_pairs,
+        num_input_rows,
+        benchmark_file_name,
+        pytest_log_file_name,
+        s3_client,
+    )
 
-    metrics_collection_end_time = datetime.utcnow() + timedelta(minutes=1)
+    # Keep the raw pytest output whether or not the run succeeded
+    upload_file_to_s3(
+        bucket_name=output_bucket,
+        file_name=pytest_log_file_name,
+        folder_path=output_folder + "/logs",
+        logger=logger,
+        s3_client=s3_client,
+    )
 
-    instance_id = get_ec2_metadata("-i")
-    instance_type = get_ec2_metadata("-t")
+    metrics_collection_end_time = datetime.now(timezone.utc) + timedelta(minutes=1)
 
     response = get_metric_data_from_ec2_run(
         cw_client=cw_client,
@@ -177,8 +374,11 @@ if __name__ == "__main__":
     )
 
     if return_code == 0:
-        with open("benchmarking_results.json", "r") as file:
-            benchmark_data = json.load(file)
+        with open(benchmark_file_name, "rb") as file:
+            benchmark_json = file.read()
+            # The file is rewritten below, so its cached pages are not needed
+            if hasattr(os, "posix_fadvise"):
+                os.posix_fadvise(file.fileno(), 0, 0, os.POSIX_FADV_DONTNEED)
 
         custom_data = {}
         custom_data["instance_id"] = instance_id
@@ -188,21 +388,21 @@ if __name__ == "__main__":
         custom_data["run_label"] = run_label
         custom_data["metrics"] = response
 
-        benchmark_data["custom"] = custom_data
-
-        with open("benchmarking_results.json", "w") as file:
-            json.dump(benchmark_data, file, indent=4, default=custom_json_serializer)
-
-        benchmark_file_name = f"benchmarking_results_{instance_id}_{run_label}.json"
-
-        os.rename("benchmarking_results.json", benchmark_file_name)
+        benchmark_json = add_custom_data_to_benchmark_json(
+            benchmark_json, custom_data, pretty=args.pretty
+        )
+        with open(benchmark_file_name, "wb") as file:
+            file.write(benchmark_json)
 
-        upload_file_to_s3(
+        # The results JSON compresses well, so upload it gzipped
+        upload_bytes_to_s3(
             bucket_name=output_bucket,
-            file_name=benchmark_file_name,
+            data=gzip.compress(benchmark_json, compresslevel=6),
+            file_name=benchmark_file_name + ".gz",
             folder_path=output_folder + "/statistics",
             logger=logger,
-            region_name=aws_region,
+            s3_client=s3_client,
+            extra_args={"ContentType": "application/json", "ContentEncoding": "gzip"},
         )
 
         model_file_name = f"splink_model_{instance_id}_{run_label}.json"
@@ -212,7 +412,7 @@ if __name__ == "__main__":
             file_name=model_file_name,
             folder_path=output_folder + "/models",
             logger=logger,
-            region_name=aws_region,
+            s3_client=s3_client,
         )
 
     else: